@@ -1,72 +1,120 @@
 """
-The following code has been adapted from https://ed25519.cr.yp.to/python/ed25519.py
-The main purpose here is to compress/decompress points.
+Thin wrapper over libsodium (through PyNaCl) for the Ed25519 operations the
+server needs. Point validation, scalar multiplication and signature
+verification all run in libsodium's constant-time C implementation.
 
 Written by Matthew Richards.
 """
 
-__all__ = ["compress_key", "decompress_key"]
+__all__ = ["validate_key", "generate_challenge", "get_verifier", "verify", "verify_async"]
 
-from Crypto.PublicKey import ECC
-from Crypto.Signature import eddsa
+import asyncio
+import contextvars
+import functools
+import nacl.bindings
+import nacl.signing
+import nacl.utils
+from nacl.exceptions import BadSignatureError
 
-b = 256
-q = 2**255 - 19
-
-def inv(x: int) -> int:
-    return pow(x, q - 2, q)
-
-d = -121665 * inv(121666)
-I = pow(2, (q - 1) // 4, q)
-
-def xrecover(y: int) -> int:
-    xx = (y * y - 1) * inv(d * y * y + 1)
-    x = pow(xx, (q + 3) // 8, q)
-    if (x*x - xx) % q != 0:
-        x = (x * I) % q
-    if x % 2 != 0:
-        x = q - x
-    return x
-
-def compress(x: int, y: int) -> int:
-    return ((x & 1) << 255) | y
-
-def compress_key(point: ECC.EccPoint) -> str:
-    """Compress a point"""
-    return compress(int(point.x), int(point.y)).to_bytes(32, "little").hex()
-
-def decompress_key(key_hex: str) -> ECC.EccPoint:
-    """Decompress a point"""
-    key_byte = bytes.fromhex(key_hex)
-    key = int.from_bytes(key_byte, "little")
-    x_odd = key >> 255
-    y = key & ~(1 << 255)
-    x = xrecover(y)
-    if x & 1 != x_odd:
-        x = q - x
-    return ECC.EccPoint(x, y, "Ed25519")
+@functools.lru_cache(maxsize=4096)
+def validate_key(key: bytes) -> bytes:
+    """
+    Check that the bytes are a valid compressed point.
+    Returns the key, errors out on invalid keys.
+    Results are cached since user keys are checked on every request.
+    """
+    if len(key) != 32 or not nacl.bindings.crypto_core_ed25519_is_valid_point(key):
+        raise ValueError("Invalid Ed25519 point.")
+    return key
 
-def generate_challenge(public: str) -> "tuple[str, str]":
+def generate_challenge(public: bytes) -> "tuple[str, str]":
     """
-    Returns a (chal, expected) tuple.
+    Returns a (chal, expected) tuple as hex strings.
     Assumes the public key has been checked before.
     """
-    public_key = decompress_key(public)
-    key = ECC.generate(curve="Ed25519")
-    return compress_key(key.pointQ), compress_key(public_key * key.d)
+    public_key = validate_key(public)
+    secret = nacl.utils.random(nacl.bindings.crypto_scalarmult_ed25519_SCALARBYTES)
+    chal = nacl.bindings.crypto_scalarmult_ed25519_base(secret)
+    expected = nacl.bindings.crypto_scalarmult_ed25519(secret, public_key)
+    return chal.hex(), expected.hex()
+
+@functools.lru_cache(maxsize=4096)
+def get_verifier(public: bytes) -> nacl.signing.VerifyKey:
+    """
+    Get the verifier object for a public key, validating the key first.
+    Cached since the same user keys verify message after message.
+    """
+    return nacl.signing.VerifyKey(validate_key(public))
 
-def verify(public: str, message: str, signature: str) -> bool:
+def verify(public: bytes, message: bytes, signature: bytes) -> bool:
     """
     Verify a message with a public key and signature.
     Returns true on success, errors out for any failure reason:
-    - Inputs not hex strings
     - Public key not valid
     - Signature fails to verify
     """
-    pointx, pointy = decompress_key(public).xy
-    key = ECC.construct(curve = "Ed25519", point_x = pointx, point_y = pointy)
-    signer = eddsa.new(key, "rfc8032")
-    message_bytes = bytes.fromhex(message)
-    signature_bytes = bytes.fromhex(signature)
-    signer.verify(message_bytes, signature_bytes)
+    try:
+        get_verifier(public).verify(message, signature)
+    except BadSignatureError as e:
+        # Keep reporting failures as malformed data.
+        raise ValueError("The signature is not authentic.") from e
     return True
+
+# Verifications waiting for the next batch. Each item is (public, message, signature, future).
+_pending: "list[tuple[bytes, bytes, bytes, asyncio.Future]]" = []
+_flush_scheduled = False
+BATCH_SIZE = 64
+
+def _verify_batch(batch: "list[tuple[bytes, bytes, bytes]]") -> list:
+    """Verify several signatures in a worker thread. Returns None for
+    each success and the raised error for each failure."""
+    results = []
+    for public, message, signature in batch:
+        try:
+            verify(public, message, signature)
+            results.append(None)
+        except Exception as e:
+            results.append(e)
+    return results
+
+def _resolve(batch: list, job: asyncio.Future):
+    """Hand the batch results back to the waiting coroutines."""
+    try:
+        results = job.result()
+    except Exception as e:
+        results = [e] * len(batch)
+    for (_, _, _, future), error in zip(batch, results):
+        if future.cancelled():
+            continue
+        if error is None:
+            future.set_result(True)
+        else:
+            future.set_exception(error)
+
+def _flush():
+    """Send everything queued since the last loop tick to the executor."""
+    global _flush_scheduled
+    _flush_scheduled = False
+    loop = asyncio.get_running_loop()
+    while _pending:
+        batch = _pending[:BATCH_SIZE]
+        del _pending[:BATCH_SIZE]
+        job = loop.run_in_executor(None, _verify_batch, [item[:3] for item in batch])
+        job.add_done_callback(functools.partial(_resolve, batch))
+
+async def verify_async(public: bytes, message: bytes, signature: bytes) -> bool:
+    """
+    Same as verify but runs in a worker thread so the event loop is free
+    to handle other clients. Requests made in the same loop tick are
+    verified together as one executor job. libsodium releases the GIL
+    while verifying.
+    """
+    global _flush_scheduled
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+    _pending.append((public, message, signature, future))
+    if not _flush_scheduled:
+        _flush_scheduled = True
+        # Run outside the caller's context, the batch serves many callers.
+        loop.call_soon(_flush, context=contextvars.Context())
+    return await future
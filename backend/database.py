@@ -1,9 +1,13 @@
-from collections import defaultdict
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 from datetime import datetime
-from functools import wraps
+from functools import lru_cache, wraps
 import json
+import os
 from peewee import * # type: ignore - importing all from peewee is fine.
-from playhouse.shortcuts import model_to_dict, update_model_from_dict
+from playhouse.pool import PooledSqliteExtDatabase
+from playhouse.shortcuts import model_to_dict
 from typing import Literal, Union
 import utils
 
@@ -15,26 +19,67 @@ logger.addHandler(logging.StreamHandler())
 
 status_type = Union[Literal['block'], Literal['friend'], Literal['request']]
 
-# in memory database
-db = SqliteDatabase(":memory:", pragmas={
+# Kept next to this file unless DATABASE_PATH says otherwise, so the working
+# directory doesn't decide which database is opened. The demo at the bottom
+# runs against a throwaway in-memory one.
+if __name__ == "__main__":
+    DATABASE_PATH = ":memory:"
+else:
+    DATABASE_PATH = os.environ.get(
+        "DATABASE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.db"))
+
+# WAL mode lets readers run alongside the writer and avoids an fsync per commit.
+db = PooledSqliteExtDatabase(DATABASE_PATH, max_connections=8, stale_timeout=300, pragmas={
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "temp_store": "memory",
+    "mmap_size": 1 << 28, # 256MB
+    "cache_size": -65536, # 64MB
     "foreign_keys": 1
 })
 
+# Threads for running queries off the event loop. Each worker keeps its own
+# pooled connection, so stay below max_connections.
+executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db")
+
+async def run_async(f, *args):
+    """Run a blocking database call in a db worker thread. The request cache
+    context is carried over so cached() and writes still see it."""
+    loop = asyncio.get_running_loop()
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, ctx.run, f, *args)
+
 class BaseModel(Model):
     # id field not specified because peewee adds one for us.
     class Meta:
         database = db
 
+class HexBlobField(BlobField):
+    """Stores keys and signatures as raw bytes but keeps hex at the API.
+    Accepts either a hex string or bytes when writing."""
+    def db_value(self, value):
+        if isinstance(value, str):
+            value = bytes.fromhex(value)
+        return super().db_value(value)
+
+    def python_value(self, value):
+        return None if value is None else bytes(value).hex()
+
 class User(BaseModel):
     username = CharField(unique=True, index=True)
-    public_key = FixedCharField(64) # 32 bytes
-    spk = FixedCharField(64, null=True) # 32 bytes
-    sig = FixedCharField(128, null=True) # sig(spk)
+    public_key = HexBlobField() # 32 bytes
+    spk = HexBlobField(null=True) # 32 bytes
+    sig = HexBlobField(null=True) # sig(spk)
     status = CharField(default=lambda: "online")
     biography = FixedCharField(500, default=lambda: "")
     profile_picture = CharField(default=lambda: "")
     own_storage = CharField(default=lambda: "")
-    x3dh_requests = CharField(default=lambda: "[]")
+
+class X3DHRequest(BaseModel):
+    # Pending X3DH payloads for a user that was offline when a dm was made.
+    user = ForeignKeyField(User, backref="+")
+    payload = TextField() # JSON
+    created_at = DateTimeField(default=utils.now)
 
 class Relation(BaseModel):
     from_user = ForeignKeyField(User, backref="outgoing_relations")
@@ -54,69 +99,111 @@ class DM(BaseModel):
     public_keys = CharField() # Concat of public key tree as array
     name = CharField(null=True)
     created_at = DateTimeField()
+    # Denormalised so listing dms doesn't have to search their messages.
+    latest_message = DeferredForeignKey("Message", null=True, backref="+")
 
 class Message(BaseModel):
     dm = ForeignKeyField(DM, backref="messages")
     sender = ForeignKeyField(User, backref="+")
     message = CharField() # Encrypted
-    signature = FixedCharField(128) # sig(encrypted message)
-    timestamp = DateTimeField(index=True)
+    signature = HexBlobField() # sig(encrypted message)
+    timestamp = DateTimeField()
     delete_timestamp = DateTimeField(null=True)
     pinned = BooleanField(default=False)
+    class Meta:
+        # Message history is always read per dm in timestamp order.
+        indexes = ((("dm", "timestamp"), False),)
 
 class Reaction(BaseModel):
     message = ForeignKeyField(Message, backref="reactions")
     sender = ForeignKeyField(User, backref="+")
     reaction = CharField() # Encrypted
-    signature = FixedCharField(128) # sig(encrypted reaction)
+    signature = HexBlobField() # sig(encrypted reaction)
+
+# Partial index so pinned lookups only touch pinned messages.
+Message.add_index(Message.dm, Message.timestamp, where=SQL("pinned = 1"), name="message_pinned_partial")
 
 # Initalisation of the database.
 UserDM = DM.users.get_through_model()
-db.create_tables([
+# The through model already has a unique (dm_id, user_id) index. The reverse
+# order makes membership lookups by user a covering index probe.
+UserDM.add_index(UserDM.user, UserDM.dm, unique=True, name="userdm_user_dm_uniq")
+tables = [
     User,
+    X3DHRequest,
     Relation,
     DM,
     Message,
     Reaction,
     UserDM
-])
+]
+# Bump when the models change. There are no migrations, so a database written
+# with another schema is cleared and recreated instead of being half used.
+SCHEMA_VERSION = 1
+if db.pragma("user_version") != SCHEMA_VERSION:
+    db.pragma("foreign_keys", 0)
+    db.drop_tables(tables)
+    db.pragma("foreign_keys", 1)
+    db.create_tables(tables)
+    db.pragma("user_version", SCHEMA_VERSION)
 
 def atomic_wrapper(f):
-    """Makes everything in this function call atomic."""
+    """Makes everything in this function call atomic. The write lock is taken
+    when the transaction starts: db worker threads write alongside the event
+    loop, and a deferred transaction that reads before writing fails with
+    "database is locked" if another connection commits in between."""
     @wraps(f)
     def wrapper(*args, **kwargs):
-        with db.atomic():
+        # Reads cached earlier in the request may be stale after this.
+        utils.clear_request_cache()
+        with db.atomic("IMMEDIATE"):
             return f(*args, **kwargs)
     return wrapper
 
+def read_only(f):
+    """Marks a function that only reads. No explicit transaction is opened so
+    reads don't queue behind writers; SQLite gives each statement a consistent
+    snapshot already."""
+    return f
+
 # All the below functions assume checks on input have already taken place.
 
 
 #### USER FUNCTIONS ###
 
 @atomic_wrapper
-def create_user(username: str, public_key: str, spk: str, sig: str, own_storage: str):
+def create_user(username: str, public_key: bytes, spk: bytes, sig: bytes, own_storage: str):
     """Create the user."""
-    User.create(username=username, public_key=public_key, spk=spk, sig=sig, own_storage=own_storage)
+    User.insert(username=username, public_key=public_key, spk=spk, sig=sig, own_storage=own_storage).execute()
 
-@atomic_wrapper
+@read_only
 def get_user(username: str):
     """Get everything about the user as a dictionary."""
     u = User.get(User.username == username)
     return model_to_dict(u)
 
-@atomic_wrapper
+@read_only
+def get_users_bulk(usernames: "list[str]"):
+    """Get everything about several users in one query.
+    Returns a dict keyed by username. Missing users are left out."""
+    query = User.select().where(User.username.in_(usernames))
+    return {u.username: model_to_dict(u) for u in query}
+
+@lru_cache(maxsize=4096)
+def get_user_id(username: str) -> int:
+    """Get the id for a username. Usernames never change so this is cached."""
+    return User.select(User.id).where(User.username == username).get().id
+
+@read_only
 def get_user_list():
-    """Get a list of all users. Excludes own storage and x3dh requests."""
-    exclude = [User.own_storage, User.x3dh_requests]
+    """Get a list of all users. Excludes own storage."""
+    exclude = [User.own_storage]
     return [model_to_dict(u, exclude=exclude) for u in User.select()]
 
 @atomic_wrapper
 def set_user_props(username: str, props):
     """Update the user's information from the given dictionary."""
-    u = User.get(User.username == username)
-    update_model_from_dict(u, props)
-    u.save()
+    User.update(**props).where(User.username == username).execute()
 
 
 ### DM FUNCTIONS ###
@@ -126,66 +213,46 @@ def create_dm(usernames: "list[str]", public_keys: "list[str]"):
     """Create a DM of all usernames and the specified flattened key tree.
     Returns the new dm id."""
     key_tree = json.dumps(public_keys)
-    d = DM.create(public_keys=key_tree, created_at=utils.now())
-    users = User.select().where(User.username.in_(usernames))
-    d.users.add(users)
-    d.save()
-    return d.id
+    dm_id = DM.insert(public_keys=key_tree, created_at=utils.now()).execute()
+    users = User.select(Value(dm_id), User.id).where(User.username.in_(usernames))
+    UserDM.insert_from(users, [UserDM.dm, UserDM.user]).execute()
+    return dm_id
 
-@atomic_wrapper
+@read_only
 def get_dm(dm_id: int):
     """Get the information for the specified dm. This includes the user list and latest message."""
     q = DM.select(DM, User.username).join(UserDM).join(User).where(UserDM.dm_id == dm_id)
-    d = model_to_dict(q[0])
+    d = model_to_dict(q[0], recurse=False)
     d["users"] = [dm.dmuserthrough.user.username for dm in q]
 
-    # Get latest message.
-    m2 = Message.alias()
-    u2 = User.alias()
-    data = (Message.select(Message, User.username, Reaction, u2.username)
-            .join(User)
-            .switch(Message)
-            .join(Reaction, JOIN.LEFT_OUTER)
-            .join(u2, JOIN.LEFT_OUTER)
-            .where((Message.timestamp == m2.select(fn.MAX(m2.timestamp)).where(m2.dm == Message.dm))
-                   & (Message.dm == dm_id))
-            )
-
-    if len(data) == 0:
-        d["latest_message"] = None
-    else:
-        d["latest_message"] = model_to_dict(data[0], recurse=False)
-        d["latest_message"]["sender"] = data[0].sender.username
-        # This is omega cursed because peewee doesn't give a nicer way to handle this case.
-        if hasattr(data[0], "reaction"):
-            d["latest_message"]["reactions"] = [reaction_to_dict(m.reaction) for m in data]
-        else:
-            d["latest_message"]["reactions"] =[]
+    # Latest message is tracked on the dm so this is a lookup by id.
+    if d["latest_message"] is not None:
+        latest = get_message(d["latest_message"])
+        # The latest message has always been keyed by "dm" here.
+        latest["dm"] = latest.pop("dm_id")
+        d["latest_message"] = latest
 
     return d
 
-@atomic_wrapper
+@read_only
 def get_user_dms(username: str):
     """Get a list of dms ids that this user is a part of."""
-    q = (User.select(DM)
-         .join(UserDM)
-         .join(DM)
-         .where((User.username == username)))
+    q = (UserDM.select(UserDM.dm)
+         .join(User)
+         .where(User.username == username))
 
-    return [u.dmuserthrough.dm.id for u in q]
+    return [udm.dm_id for udm in q]
 
 @atomic_wrapper
 def set_dm_props(dm_id: int, props):
     """Update the dm's information. Only use right now is for the name of the dm."""
-    d = DM.get_by_id(dm_id)
-    update_model_from_dict(d, props)
-    d.save()
+    DM.update(**props).where(DM.id == dm_id).execute() # type: ignore - DM.id exists.
 
 @atomic_wrapper
 def leave_dm(dm_id: int, username: str):
     """Remove a user from the dm."""
-    u = User.get(User.username == username)
-    UserDM.delete().where((UserDM.user == u.id) & (UserDM.dm == dm_id)).execute()
+    user_id = get_user_id(username)
+    UserDM.delete().where((UserDM.user == user_id) & (UserDM.dm == dm_id)).execute()
 
 
 ### MESSAGE FUNCTIONS ###
@@ -193,120 +260,67 @@ def leave_dm(dm_id: int, username: str):
 @atomic_wrapper
 def create_message(dm_id: int, username: str, message: str, sig: str, d_time = 0):
     """Add a message into the database with specified time. Returns the dict for it."""
-    sender = User.get(User.username == username)
+    sender = get_user_id(username)
     time = utils.now()
     if d_time <= 0:
         d_time = None
     else:
         d_time = utils.now_delta(d_time)
 
-    m = Message.create(dm=dm_id, sender=sender, message=message, signature=sig, timestamp=time, delete_timestamp=d_time)
-    model = model_to_dict(m, recurse=False)
-    model["dm_id"] = model.pop("dm")
-    model["reactions"] = []
-    model["sender"] = username
-    return model
-
-@atomic_wrapper
+    m_id = Message.insert(dm=dm_id, sender=sender, message=message, signature=sig, timestamp=time, delete_timestamp=d_time).execute()
+    DM.update(latest_message=m_id).where(DM.id == dm_id).execute() # type: ignore - DM.id exists.
+    # Build the dict here instead of reading the row back.
+    return {
+        "id": m_id,
+        "sender": username,
+        "message": message,
+        "signature": sig,
+        "timestamp": time,
+        "delete_timestamp": d_time,
+        "pinned": False,
+        "dm_id": dm_id,
+        "reactions": []
+    }
+
+@read_only
 def get_message(m_id):
     """Get a single message."""
-    User2 = User.alias()
-    query = (Message.select(Message, User.username, Reaction, User2.username)
+    query = (Message.select(Message, User.username, reactions_subquery().alias("reactions_json"))
              .join(User)
-             .switch(Message)
-             .join(Reaction, JOIN.LEFT_OUTER)
-             .join(User2, JOIN.LEFT_OUTER)
              .where(Message.id == m_id)) # type: ignore - Message.id exists
 
-    model = model_to_dict(query[0], recurse=False)
-    model["sender"] = query[0].sender.username
-    model["dm_id"] = model.pop("dm")
-    if hasattr(query[0], "reaction"):
-        model["reactions"] = [reaction_to_dict(m.reaction) for m in query]
-    else:
-        model["reactions"] = []
-
-    return model
+    message = query.get()
+    return message_to_dict(message, json.loads(message.reactions_json))
 
-@atomic_wrapper
+@read_only
 def get_messages(dm_id: int, cursor: datetime, count: int):
     """Get messages for a specific dm. cursor and count are used for pagination.
     Returned messages are in order starting from most recent."""
-    m_query = (Message.select(Message, User.username)
+    m_query = (Message.select(Message, User.username, reactions_subquery().alias("reactions_json"))
              .join(User)
              .where((Message.dm == dm_id) &
                     (Message.timestamp < cursor))
              .order_by(Message.timestamp.desc())
              .limit(count))
 
-    if len(m_query) == 0:
-        return []
-
-    # Query results are cached so m_query doesn't generate new SQL queries.
-    start = m_query[-1].timestamp
-
-    r_query = (Reaction.select(Reaction, Message, User.username)
-               .join(Message)
-               .switch(Reaction)
-               .join(User)
-               .where(
-                    (Message.dm == dm_id)
-                    & (Message.timestamp >= start)
-                    & (Message.timestamp < cursor)))
-
-    reaction_map = defaultdict(list)
-    for reaction in r_query:
-        reaction_map[reaction.message.id].append(reaction_to_dict(reaction))
-
-    ret = []
-    for message in m_query:
-        m = model_to_dict(message, recurse=False)
-        m["sender"] = message.sender.username
-        m["dm_id"] = m.pop("dm")
-        m["reactions"] = reaction_map[m["id"]]
-        ret.append(m)
-
-    return ret
+    return [message_to_dict(m, json.loads(m.reactions_json)) for m in m_query]
 
-@atomic_wrapper
+@read_only
 def get_pinned_messages(dm_id: int):
     """Get messages for a specific dm. cursor and count are used for pagination.
     Returned messages are in order starting from most recent."""
-    m_query = (Message.select(Message, User.username)
+    m_query = (Message.select(Message, User.username, reactions_subquery().alias("reactions_json"))
              .join(User)
              .where((Message.dm == dm_id) &
                     (Message.pinned == True))
              .order_by(Message.timestamp.desc()))
 
-    if len(m_query) == 0:
-        return []
-
-    r_query = (Reaction.select(Reaction, Message, User.username)
-               .join(Message)
-               .switch(Reaction)
-               .join(User)
-               .where((Message.dm == dm_id) & (Message.pinned == True)))
-
-    reaction_map = defaultdict(list)
-    for reaction in r_query:
-        reaction_map[reaction.message.id].append(reaction_to_dict(reaction))
-
-    ret = []
-    for message in m_query:
-        m = model_to_dict(message, recurse=False)
-        m["sender"] = message.sender.username
-        m["dm_id"] = m.pop("dm")
-        m["reactions"] = reaction_map[m["id"]]
-        ret.append(m)
-
-    return ret
+    return [message_to_dict(m, json.loads(m.reactions_json)) for m in m_query]
 
 @atomic_wrapper
 def set_message_props(m_id: int, props):
     """Update the message's information. Used for edits and pins."""
-    d = Message.get_by_id(m_id)
-    update_model_from_dict(d, props)
-    d.save()
+    Message.update(**props).where(Message.id == m_id).execute() # type: ignore - Message.id exists.
 
 @atomic_wrapper
 def delete_message(m_id: int):
@@ -314,16 +328,23 @@ def delete_message(m_id: int):
     Reaction.delete().where(Reaction.message == m_id).execute()
     Message.delete_by_id(m_id)
 
+    # Point the dm at its new latest message if this one was it.
+    latest = (Message.select(Message.id)
+              .where(Message.dm == DM.id)
+              .order_by(Message.timestamp.desc())
+              .limit(1))
+    DM.update(latest_message=latest).where(DM.latest_message == m_id).execute()
+
 
 ### REACTION FUNCTIONS ###
 
 @atomic_wrapper
 def create_reaction(message_id: int, username: str, reaction: str, sig: str):
     """Add a reaction into the database."""
-    sender = User.get(User.username == username)
-    r = Reaction.create(message=message_id, sender=sender, reaction=reaction, signature=sig)
-    return r.id
+    sender = get_user_id(username)
+    return Reaction.insert(message=message_id, sender=sender, reaction=reaction, signature=sig).execute()
 
+@read_only
 def get_reaction(reaction_id: int):
     """Get the information for a single reaction."""
     query = (Reaction.select(Reaction, User.username)
@@ -331,7 +352,7 @@ def get_reaction(reaction_id: int):
              .where(Reaction.id == reaction_id)) # type: ignore
     return reaction_to_dict(query.get())
 
-@atomic_wrapper
+@read_only
 def get_reactions(message_id: int):
     """Get reactions for a specific message.
     Returned reactions are given in any order."""
@@ -350,27 +371,37 @@ def delete_reaction(reaction_id: int):
 
 ### RELATION FUNCTIONS ###
 
+def forgets_friends(f):
+    """Drop the cached friend sets of the two users passed to f once its
+    transaction has committed. Put above atomic_wrapper."""
+    @wraps(f)
+    def wrapper(username1: str, username2: str, *args):
+        try:
+            return f(username1, username2, *args)
+        finally:
+            forget_friends(username1, username2)
+    return wrapper
+
+@forgets_friends
 @atomic_wrapper
 def create_relation(username1: str, username2: str, status: status_type):
     """Create a relation from one user to the other."""
-    user1 = User.get(User.username == username1)
-    user2 = User.get(User.username == username2)
-    Relation.create(from_user=user1, to_user=user2, status_code=status)
+    user1 = get_user_id(username1)
+    user2 = get_user_id(username2)
+    Relation.insert(from_user=user1, to_user=user2, status_code=status).execute()
 
+@forgets_friends
 @atomic_wrapper
 def set_relation_props(username1: str, username2: str, props):
     """Updates the relation (directional) with the props. Currently only used
     for changing status."""
-    User2 = User.alias()
-    r = (Relation.select()
-         .join(User, on=Relation.from_user)
-         .switch(Relation)
-         .join(User2, on=Relation.to_user)
-         .where((User.username == username1) & (User2.username == username2))
-         ).get()
-    update_model_from_dict(r, props)
-    r.save()
+    user1 = get_user_id(username1)
+    user2 = get_user_id(username2)
+    (Relation.update(**props)
+     .where((Relation.from_user == user1) & (Relation.to_user == user2))
+     .execute())
 
+@forgets_friends
 @atomic_wrapper
 def delete_relation(username1: str, username2: str):
     """Delete a relation from user1 to user2. Purpose is for unfriending,
@@ -384,23 +415,44 @@ def delete_relation(username1: str, username2: str):
          ).get()
     r.delete_instance()
 
-@atomic_wrapper
+@read_only
 def is_relation(username1: str, username2: str, status: status_type):
     """Determine if two users have such a status from u1 to u2."""
     User2 = User.alias()
-    c = (Relation.select()
-         .join(User, on=Relation.from_user)
-         .switch(Relation)
-         .join(User2, on=Relation.to_user)
-         .where((User.username == username1) & (User2.username == username2)
-                & (Relation.status_code == status))
-         ).count()
-    return c != 0
+    return (Relation.select()
+            .join(User, on=Relation.from_user)
+            .switch(Relation)
+            .join(User2, on=Relation.to_user)
+            .where((User.username == username1) & (User2.username == username2)
+                   & (Relation.status_code == status))
+            ).exists()
+
+@read_only
+def get_relations_between(username1: str, username2: str):
+    """Get everything about how two users relate in one go. Returns a dict with
+    whether each user exists and the status from u1 to u2 and u2 to u1 (or None)."""
+    ids = {u.username: u.id for u in User.select(User.id, User.username)
+                                          .where(User.username.in_([username1, username2]))}
+    ret = {
+        "a_exists": username1 in ids,
+        "b_exists": username2 in ids,
+        "a_to_b": None,
+        "b_to_a": None
+    }
+    if ret["a_exists"] and ret["b_exists"]:
+        user1 = ids[username1]
+        user2 = ids[username2]
+        query = (Relation.select(Relation.from_user, Relation.status_code)
+                 .where(((Relation.from_user == user1) & (Relation.to_user == user2))
+                        | ((Relation.from_user == user2) & (Relation.to_user == user1))))
+        for r in query:
+            ret["a_to_b" if r.from_user_id == user1 else "b_to_a"] = r.status_code
+    return ret
 
-@atomic_wrapper
+@read_only
 def get_outgoing_of_status(username: str, status: status_type):
     """Get a list of usernames with the given status outgoing."""
-    user = User.get(User.username == username)
+    user = get_user_id(username)
     query = (
         User.select(User.username)
         .join(Relation, on=Relation.to_user)
@@ -408,10 +460,10 @@ def get_outgoing_of_status(username: str, status: status_type):
     )
     return [u.username for u in query]
 
-@atomic_wrapper
+@read_only
 def get_incoming_of_status(username: str, status: status_type):
     """Get a list of usernames with the given status incoming."""
-    user = User.get(User.username == username)
+    user = get_user_id(username)
     query = (
         User.select(User.username)
         .join(Relation, on=Relation.from_user)
@@ -419,28 +471,52 @@ def get_incoming_of_status(username: str, status: status_type):
     )
     return [u.username for u in query]
 
-@atomic_wrapper
-def get_of_status(username: str, status: status_type):
-    """Get a list of usernames where there is a relation of the given status involving the
+@read_only
+def get_of_status(username: str, status: status_type) -> "frozenset[str]":
+    """Get the set of usernames where there is a relation of the given status involving the
     given username (bidirectional)."""
-    Relation2 = Relation.alias()
-    User2 = User.alias()
-    User3 = User.alias()
-
-    query = (
+    user = get_user_id(username)
+    # One indexed lookup per direction instead of a join over both.
+    outgoing = (
         User.select(User.username)
-        .join(Relation, JOIN.LEFT_OUTER, on=Relation.from_user)
-        .join(User2, JOIN.LEFT_OUTER, on=Relation.to_user)
-        .switch(User)
-        .join(Relation2, JOIN.LEFT_OUTER, on=Relation2.to_user)
-        .join(User3, JOIN.LEFT_OUTER, on=Relation2.from_user)
-        .where(
-            ((User2.username == username) & (Relation.status_code == status)) # to us.
-            | ((User3.username == username) & (Relation2.status_code == status)) # from us.
-        )
+        .join(Relation, on=Relation.to_user)
+        .where((Relation.from_user == user) & (Relation.status_code == status))
     )
-
-    return [u.username for u in query]
+    incoming = (
+        User.select(User.username)
+        .join(Relation, on=Relation.from_user)
+        .where((Relation.to_user == user) & (Relation.status_code == status))
+    )
+    query = outgoing | incoming
+
+    return frozenset(u.username for u in query)
+
+# username -> friends, filled on first lookup and dropped when a relation changes.
+friends_cache: "dict[str, frozenset[str]]" = {}
+# Bumped by forget_friends. Relation writes run in db worker threads too, so a
+# lookup that overlapped a change doesn't get cached.
+friends_generation = 0
+
+def get_friends(username: str) -> "frozenset[str]":
+    """Get the usernames this user is friends with. Cached between relation changes."""
+    friends = friends_cache.get(username)
+    if friends is None:
+        generation = friends_generation
+        friends = get_of_status(username, "friend")
+        if generation == friends_generation:
+            friends_cache[username] = friends
+    return friends
+
+def are_friends(username1: str, username2: str) -> bool:
+    """Whether the two users are friends, from the cached friend sets."""
+    return username2 in get_friends(username1)
+
+def forget_friends(*usernames: str):
+    """Drop cached friend sets after a relation between these users changed."""
+    global friends_generation
+    friends_generation += 1
+    for username in usernames:
+        friends_cache.pop(username, None)
 
 
 ### OTHER FUNCTIONS ###
@@ -448,93 +524,110 @@ def get_of_status(username: str, status: status_type):
 @atomic_wrapper
 def append_x3dh(username: str, payload: dict):
     """Append a X3DH payload to the target's inbox."""
-    u = User.get(User.username == username)
-    curr = json.loads(u.x3dh_requests)
-    curr.append(payload)
-    u.x3dh_requests = json.dumps(curr)
-    u.save()
+    u = get_user_id(username)
+    X3DHRequest.insert(user=u, payload=json.dumps(payload)).execute()
 
 @atomic_wrapper
 def get_and_clear_x3dh(username: str):
     """Get this user's X3DH payload list. Then clears the list."""
-    u = User.get(User.username == username)
-    l = json.loads(u.x3dh_requests)
-    u.x3dh_requests = "[]"
-    u.save()
+    u = get_user_id(username)
+    query = X3DHRequest.select().where(X3DHRequest.user == u).order_by(X3DHRequest.id)
+    l = [json.loads(r.payload) for r in query]
+    X3DHRequest.delete().where(X3DHRequest.user == u).execute()
     return l
 
+@atomic_wrapper
+def requeue_x3dh(username: str, payloads: list):
+    """Put X3DH payloads taken by get_and_clear_x3dh back in the inbox."""
+    u = get_user_id(username)
+    rows = [{"user": u, "payload": json.dumps(p)} for p in payloads]
+    X3DHRequest.insert_many(rows).execute()
+
 def reaction_to_dict(reaction):
     """Convert a reaction to a dict."""
-    fields = [Reaction.id, Reaction.reaction, Reaction.signature] # type: ignore - Reaction.id exists
-    r = model_to_dict(reaction, only=fields)
-    r["sender"] = reaction.sender.username # Make sure to select the username as well.
-    return r
+    return {
+        "id": reaction.id,
+        "reaction": reaction.reaction,
+        "signature": reaction.signature,
+        "sender": reaction.sender.username # Make sure to select the username as well.
+    }
+
+def message_to_dict(message, reactions: list):
+    """Convert a message to a dict. The sender's username must be selected
+    with the message, and reactions are passed in already converted."""
+    return {
+        "id": message.id,
+        "dm_id": message.dm_id,
+        "sender": message.sender.username,
+        "message": message.message,
+        "signature": message.signature,
+        "timestamp": message.timestamp,
+        "delete_timestamp": message.delete_timestamp,
+        "pinned": message.pinned,
+        "reactions": reactions
+    }
+
+def reactions_subquery():
+    """Correlated subquery that builds a message's reactions as a JSON array,
+    in the same shape as reaction_to_dict. Select it alongside Message."""
+    Sender = User.alias()
+    return (Reaction
+            .select(fn.json_group_array(fn.json_object(
+                "id", Reaction.id,
+                "reaction", Reaction.reaction,
+                "signature", fn.lower(fn.hex(Reaction.signature)),
+                "sender", Sender.username)))
+            .join(Sender, on=(Reaction.sender == Sender.id))
+            .where(Reaction.message == Message.id)) # type: ignore - Message.id exists
 
 ### CHECK FUNCTIONS ###
 
-@atomic_wrapper
+@read_only
 def user_exists(username: str):
     """True when username exists in database. False otherwise."""
-    c = (User.select()
-         .where(User.username == username)
-         .count())
-    return c != 0
+    return (User.select()
+            .where(User.username == username)
+            .exists())
 
-@atomic_wrapper
-def dm_exists(dm_id: int):
-    """True when dm exists in database. False otherwise."""
-    c = (DM.select()
-         .where(DM.id == dm_id) # type: ignore - DM.id exists.
-         .count())
-    return c != 0
-
-@atomic_wrapper
+@read_only
 def dm_users_exists(usernames: "list[str]"):
     """True when list of usernames matches exactly with an existing dm."""
-    users = set(User.select().where(User.username.in_(usernames)))
-    # This is horrible code. At least it's only 1 query per test.
-    g = (set(d.users) for d in DM.select())
-    return users in g
-
-@atomic_wrapper
-def is_individual_dm(dm_id: int):
-    """Is the user count == 2 for the given dm. Does not check dm id."""
-    count = UserDM.select().where(UserDM.dm_id == dm_id).count()
-    return count == 2
-
-@atomic_wrapper
-def user_in_dm(username: str, dm_id: int):
-    """Determine if username is a part of the dm."""
-    c = (UserDM.select()
-         .join(User)
-         .where((UserDM.dm_id == dm_id) & (User.username == username))
-         .count())
-    return c != 0
-
-@atomic_wrapper
+    user_ids = [u.id for u in User.select(User.id).where(User.username.in_(usernames))]
+    # A dm matches when it has exactly these users: its member count equals the
+    # number of users and every member is one of them.
+    n = len(user_ids)
+    members = fn.SUM(Case(None, [(UserDM.user.in_(user_ids), 1)], 0))
+    query = (UserDM.select(UserDM.dm)
+             .group_by(UserDM.dm)
+             .having((fn.COUNT(UserDM.user) == n) & (members == n)))
+    return query.exists()
+
+@read_only
+def dm_membership(dm_id: int, username: str):
+    """Get the dm as a dict when username is a part of it, None otherwise.
+    This covers the dm existing as well, so no separate check is needed."""
+    user_id = get_user_id(username)
+    dm = (DM.select()
+          .join(UserDM)
+          .where((UserDM.dm == dm_id) & (UserDM.user == user_id))
+          .first())
+    return None if dm is None else model_to_dict(dm, recurse=False)
+
+@read_only
 def message_in_user_dm(m_id: int, username: str):
     """Determine if message is a part of the user's dms."""
-    c = (Message.select()
-         .join(DM).join(UserDM).join(User)
-         .where((Message.id == m_id) & (User.username == username)) # type: ignore
-         .count())
-    return c != 0
+    user_id = get_user_id(username)
+    return (Message.select()
+            .join(UserDM, on=(UserDM.dm == Message.dm))
+            .where((Message.id == m_id) & (UserDM.user == user_id)) # type: ignore
+            .exists())
 
-@atomic_wrapper
-def message_exists(message_id: int):
-    """True when message exists in database. False otherwise."""
-    c = (Message.select()
-         .where(Message.id == message_id) # type: ignore - Message.id exists.
-         .count())
-    return c != 0
-
-@atomic_wrapper
+@read_only
 def reaction_exists(reaction_id: int):
     """True when reaction exists in database. False otherwise."""
-    c = (Reaction.select()
-         .where(Reaction.id == reaction_id) # type: ignore - Reaction.id exists.
-         .count())
-    return c != 0
+    return (Reaction.select()
+            .where(Reaction.id == reaction_id) # type: ignore - Reaction.id exists.
+            .exists())
 
 
 
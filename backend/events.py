@@ -1,114 +1,169 @@
-import asyncio
 from collections import defaultdict
-from datetime import datetime, timedelta
-import functools
+from dataclasses import dataclass
+from datetime import datetime
+import logging
 import socketio
 import socketio.exceptions
-import traceback
+import time
 import database as db
 import Ed25519
 import notifications
+import scheduler
 import utils
 
+logger = logging.getLogger("events")
+
+async def notify(coro):
+    """Await a notification sent after a write went through. Handlers start this
+    as a background task so their reply doesn't wait on the fan-out. Failures are
+    logged rather than raised so the client isn't told the write failed."""
+    try:
+        await coro
+    except Exception:
+        logger.exception("Notification failed.")
+
+# sid -> username for logged in clients. Read instead of the session on every request.
+logged_in = {}
+# sid -> failed login attempts, and sid -> monotonic time their lockout ends.
+login_fails = {}
+lockouts = {}
+
 dm_calls_map = defaultdict(dict)
+# Reverse index of dm_calls_map: username -> dm ids they are in a call for.
+user_calls = defaultdict(set)
 
-# map from dm id -> username -> sched id -> (message, timestamp, handle)
-scheduled_messages = defaultdict(lambda: defaultdict(dict))
+def add_to_call(dm_id: int, username: str, uuid: str):
+    """Add a user to a dm's call, keeping the reverse index in sync."""
+    dm_calls_map[dm_id][username] = uuid
+    user_calls[username].add(dm_id)
+
+def call_snapshot(dm_id: int) -> dict:
+    """Copy of the users in a dm's call, safe to hand to notifications."""
+    return dict(dm_calls_map.get(dm_id, ()))
 
-def error_wrap(f):
+def remove_from_call(dm_id: int, username: str):
+    """Remove a user from a dm's call, keeping the reverse index in sync."""
+    del dm_calls_map[dm_id][username]
+    user_calls[username].discard(dm_id)
+    if not user_calls[username]:
+        del user_calls[username]
+
+@dataclass(slots=True)
+class ScheduledMessage:
+    message: str
+    signature: str
+    timestamp: str
+    handles: "list[int]" # Scheduler entry ids.
+
+# map from (dm id, username, sched id) -> scheduled message
+scheduled_messages: "dict[tuple[int, str, int], ScheduledMessage]" = {}
+# Index of the sched ids pending for each (dm id, username).
+scheduled_by_dm_user: "defaultdict[tuple[int, str], set[int]]" = defaultdict(set)
+# Last sched id handed out for each (dm id, username). Ids are never reused.
+sched_id_counter: "dict[tuple[int, str], int]" = {}
+
+def add_scheduled(dm_id: int, username: str, sched_id: int, entry: ScheduledMessage):
+    """Store a scheduled message, keeping the index in sync."""
+    scheduled_messages[dm_id, username, sched_id] = entry
+    scheduled_by_dm_user[dm_id, username].add(sched_id)
+
+def remove_scheduled(dm_id: int, username: str, sched_id: int) -> ScheduledMessage:
+    """Remove a scheduled message, keeping the index in sync."""
+    entry = scheduled_messages.pop((dm_id, username, sched_id))
+    ids = scheduled_by_dm_user[dm_id, username]
+    ids.discard(sched_id)
+    if not ids:
+        del scheduled_by_dm_user[dm_id, username]
+    return entry
+
+class Handler:
     """
-    Wraps async functions in a catch-all handler that returns False on any error.
-    Ideally, this is a last resort and not relied on.
+    A registered event. Does the checks the handlers rely on in one call:
+    - Catch-all error handling that returns False on any error.
+    - Lockout and failure counting for login events.
+    - Requiring the client to be logged in.
+    - Requiring exact keys in the data (skipped when keys is None).
     """
-    @functools.wraps(f)
-    async def wrapper(*args, **kwargs):
+    __slots__ = ("sio", "f", "keys", "needs_login", "is_login")
+
+    def __init__(self, sio: socketio.AsyncServer, f, keys, needs_login: bool, is_login: bool):
+        self.sio = sio
+        self.f = f
+        # Built once here so each request only does membership checks.
+        self.keys = None if keys is None else frozenset(keys)
+        self.needs_login = needs_login
+        self.is_login = is_login
+
+    async def handle(self, sid, data):
+        # Fresh read cache for each request.
+        token = utils.request_cache.set({})
         try:
-            print(f"Calling {f.__name__} with data {args[2]}")
-            ret = await f(*args, **kwargs)
+            if logger.isEnabledFor(logging.DEBUG):
+                # Only the event name, the data can be large.
+                logger.debug("Calling %s", self.f.__name__)
+            if self.is_login:
+                ret = await self.login_attempt(sid, data)
+            else:
+                ret = await self.dispatch(sid, data)
         except ValueError:
             # This occurs from ed25519 and data parsing.
             # Still log it anyway.
-            traceback.print_exc()
+            logger.exception("Malformed data in %s", self.f.__name__)
             ret = False, "Malformed data."
         except:
             # All other errors.
             # Make sure to report the error.
-            traceback.print_exc()
+            logger.exception("Error in %s", self.f.__name__)
             ret = False, "Internal server error."
+        finally:
+            utils.request_cache.reset(token)
         return {"success": ret[0], "result": ret[1]}
-    return wrapper
-
-def login_fail_wrap(f):
-    """When a login function returns false, increment a fail counter."""
-    @functools.wraps(f)
-    async def wrapper(sio: socketio.AsyncServer, sid, data):
-        delta = timedelta(seconds=60) # 60 second lockout timer.
-        now = datetime.now()
-        async with sio.session(sid) as session:
-            # Check lockout
-            if now - session["lockout_start"] < delta:
-                # Still in lockout.
-                print(f"Sid {sid} currently in lockout.")
-                return False, "You have been locked out for 60 seconds."
-
-        val = await f(sio, sid, data)
+
+    async def dispatch(self, sid, data):
+        """Login and key checks, then the handler itself."""
+        if self.needs_login and sid not in logged_in:
+            # Client not logged in.
+            return False, "Not logged in."
+        if self.keys is not None and not check_for_keys(data, self.keys):
+            return False, "Invalid data format."
+        return await self.f(self.sio, sid, data)
+
+    async def login_attempt(self, sid, data):
+        """When a login function returns false, increment a fail counter."""
+        # Check lockout without touching the session.
+        if lockouts.get(sid, 0) > time.monotonic():
+            # Still in lockout.
+            logger.info("Sid %s currently in lockout.", sid)
+            return False, "You have been locked out for 60 seconds."
+
+        val = await self.dispatch(sid, data)
 
         if not val[0]:
-            async with sio.session(sid) as session:
-                session["login_fails"] += 1
-                if session["login_fails"] >= 10:
-                    session["lockout_start"] = now
-                    return False, val[1] + " You have been locked out for 60 seconds."
-                else:
-                    # Append remaining tries to response message.
-                    remaining = 10 - session["login_fails"]
-                    return False, val[1] + f" {remaining} attempts left before lockout."
+            fails = login_fails[sid] = login_fails.get(sid, 0) + 1
+            if fails >= 10:
+                lockouts[sid] = time.monotonic() + 60 # 60 second lockout timer.
+                return False, val[1] + " You have been locked out for 60 seconds."
+            else:
+                # Append remaining tries to response message.
+                remaining = 10 - fails
+                return False, val[1] + f" {remaining} attempts left before lockout."
         return val
-    return wrapper
-
-def login_required_wrap(f):
-    """Require the client to be logged in to proceed."""
-    @functools.wraps(f)
-    async def wrapper(sio: socketio.AsyncServer, sid, data):
-        async with sio.session(sid) as session:
-            if not session["logged_in"]:
-                # Client not logged in.
-                return False, "Not logged in."
-        return await f(sio, sid, data)
-    return wrapper
-
-def check_keys(*keys):
-    """Require specific keys when called."""
-    def outer_wrapper(f):
-        @functools.wraps(f)
-        async def wrapper(sio: socketio.AsyncServer, sid, data):
-            if not check_for_keys(data, *keys):
-                return False, "Invalid data format."
-            return await f(sio, sid, data)
-        return wrapper
-    return outer_wrapper
-
-@error_wrap
-@login_fail_wrap
-@check_keys("username")
+
 async def login(sio: socketio.AsyncServer, sid, data):
     username = data["username"]
     if not db.user_exists(username):
         # User does not exist.
         return False, "User does not exist."
+    if sid in logged_in:
+        # Client already logged in.
+        return False, "Already logged in."
     async with sio.session(sid) as session:
-        if session["logged_in"]:
-            # Client already logged in.
-            return False, "Already logged in."
-        pub = db.get_user(username)["public_key"]
-        chal, resp = Ed25519.generate_challenge(pub)
+        pub = utils.cached(db.get_user, username)["public_key"]
+        chal, resp = Ed25519.generate_challenge(bytes.fromhex(pub))
         session["challenge_response"] = resp
         session["username"] = username
     return True, chal
 
-@error_wrap
-@login_fail_wrap
-@check_keys("response")
 async def login_challenge_response(sio: socketio.AsyncServer, sid, data):
     async with sio.session(sid) as session:
         if "challenge_response" not in session:
@@ -119,37 +174,34 @@ async def login_challenge_response(sio: socketio.AsyncServer, sid, data):
         if expected != data["response"]:
             # Did not match expected response.
             return False, "Incorrect response."
-        session["logged_in"] = True
-        session["login_fails"] = 0
         username = session["username"]
+    logged_in[sid] = username
+    login_fails.pop(sid, None)
 
-    await notifications.login_join_rooms(sio, sid)
+    await notifications.login_join_rooms(sio, sid, username)
     # Notify of previous set status if it wasn't offline.
     user = db.get_user(username)
     if user["status"] != "offline":
-        utils.start_background_task(notifications.notify_profile(sio, sid, user))
+        utils.start_background_task(notify(notifications.notify_profile(sio, sid, user)))
     return True, True
 
-@error_wrap
-@check_keys("username", "public_key", "spk", "sig", "own_storage")
 async def register(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        if session["logged_in"]:
-            # Client already logged in.
-            return False, "Already logged in."
+    if sid in logged_in:
+        # Client already logged in.
+        return False, "Already logged in."
     username = data["username"]
     if db.user_exists(username):
         # User already exists.
         return False, "Username already exists."
 
-    pub = data["public_key"]
-    Ed25519.decompress_key(pub)
+    pub = bytes.fromhex(data["public_key"])
+    Ed25519.validate_key(pub)
 
     # Check signature and key validity.
-    spk = data["spk"]
-    sig = data["sig"]
-    Ed25519.verify(pub, spk, sig)
-    Ed25519.decompress_key(spk)
+    spk = bytes.fromhex(data["spk"])
+    sig = bytes.fromhex(data["sig"])
+    await Ed25519.verify_async(pub, spk, sig)
+    Ed25519.validate_key(spk)
     
     if not isinstance(data["own_storage"], str):
         return False, "Invalid data format."
@@ -157,21 +209,16 @@ async def register(sio: socketio.AsyncServer, sid, data):
     db.create_user(username, pub, spk, sig, data["own_storage"])
     return True, True
 
-@error_wrap
-@check_keys("username")
 async def username_exists(sio: socketio.AsyncServer, sid, data):
     username = data["username"]
     return True, db.user_exists(username)
 
-@error_wrap
-@login_required_wrap
-@check_keys("username")
 async def get_user(sio: socketio.AsyncServer, sid, data):
     username = data["username"]
     if not db.user_exists(username):
         # Username does not exist.
         return False, "User does not exist."
-    profile = utils.exclude_keys(db.get_user(username), ["id", "own_storage", "x3dh_requests"])
+    profile = utils.exclude_keys(db.get_user(username), {"id", "own_storage"})
 
     if not notifications.is_user_online(username):
         # When no clients with that username are connected, always return offline.
@@ -180,26 +227,16 @@ async def get_user(sio: socketio.AsyncServer, sid, data):
 
     return True, profile
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_full_user(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    profile = utils.exclude_keys(db.get_user(username), ["id", "x3dh_requests"])
+    username = logged_in[sid]
+    profile = utils.exclude_keys(db.get_user(username), {"id"})
     return True, profile
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_user_list(sio: socketio.AsyncServer, sid, data):
     return True, db.get_user_list()
 
-@error_wrap
-@login_required_wrap
 async def set_user(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
     parsed = utils.get_keys(data, ["spk", "sig", "status", "biography", "profile_picture", "own_storage"])
 
@@ -208,11 +245,11 @@ async def set_user(sio: socketio.AsyncServer, sid, data):
 
     if "spk" in parsed:
         # Check signature and key validity.
-        pub = db.get_user(username)["public_key"]
-        spk = parsed["spk"]
-        sig = parsed["sig"]
-        Ed25519.verify(pub, spk, sig)
-        Ed25519.decompress_key(spk)
+        pub = bytes.fromhex(utils.cached(db.get_user, username)["public_key"])
+        spk = bytes.fromhex(parsed["spk"])
+        sig = bytes.fromhex(parsed["sig"])
+        await Ed25519.verify_async(pub, spk, sig)
+        Ed25519.validate_key(spk)
     
     if "biography" in parsed:
         if not isinstance(parsed["biography"], str) or len(parsed["biography"]) > 500:
@@ -224,43 +261,41 @@ async def set_user(sio: socketio.AsyncServer, sid, data):
 
     db.set_user_props(username, parsed)
 
-    user = utils.exclude_keys(db.get_user(username), ["id", "own_storage", "x3dh_requests"])
-    utils.start_background_task(notifications.notify_profile(sio, sid, user))
+    user = utils.exclude_keys(db.get_user(username), {"id", "own_storage"})
+    utils.start_background_task(notify(notifications.notify_profile(sio, sid, user)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("usernames", "messages", "key_tree")
 async def create_dm(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        sender = session["username"]
+    sender = logged_in[sid]
 
     pairs = list(zip(data["usernames"], data["messages"]))
+    # Fetch everyone up front instead of once per recipient.
+    users = db.get_users_bulk([sender, *data["usernames"]])
     for username, message in pairs:
-        if not db.user_exists(username):
+        if username not in users:
             # Username does not exist.
             return False, "User does not exist."
 
         spk = message["spk"]
-        if spk != db.get_user(username)["spk"]:
+        if spk != users[username]["spk"]:
             # SPK does not matched the one saved.
             return False, "SPK does not match."
 
         ek = message["ek"]
         # Verify key is valid.
-        Ed25519.decompress_key(ek)
+        Ed25519.validate_key(bytes.fromhex(ek))
 
     if len(pairs) == 1 and db.dm_users_exists([sender, *data["usernames"]]):
         # If the individual dm exists already.
         return False, "DM with that user already exists."
 
-    if len(pairs) == 1 and sender not in db.get_of_status(data["usernames"][0], "friend"):
+    if len(pairs) == 1 and not db.are_friends(data["usernames"][0], sender):
         # Individual dm participants need to be friends.
         return False, "You need to be friends to make that DM."
 
     # Check key tree
     for k in data["key_tree"]:
-        Ed25519.decompress_key(k)
+        Ed25519.validate_key(bytes.fromhex(k))
 
     # Create the dm
     dm_id = db.create_dm([sender, *data["usernames"]], data["key_tree"])
@@ -268,7 +303,7 @@ async def create_dm(sio: socketio.AsyncServer, sid, data):
     for i, (name, message) in enumerate(pairs, start=1):
         x3dh = {
             "sender": sender,
-            "ik": db.get_user(sender)["public_key"],
+            "ik": users[sender]["public_key"],
             "spk": message["spk"],
             "ek": message["ek"],
             "key_tree": data["key_tree"],
@@ -278,219 +313,186 @@ async def create_dm(sio: socketio.AsyncServer, sid, data):
 
         if notifications.is_user_online(name):
             # Online to be able to receive it.
-            utils.start_background_task(notifications.notify_x3dh(sio, name, x3dh))
+            utils.start_background_task(notify(notifications.notify_x3dh(sio, name, x3dh)))
         else:
             # Offline so store it for later.
             db.append_x3dh(name, x3dh)
 
-    await notifications.join_new_dm(sio, dm_id)
+    await notify(notifications.join_new_dm(sio, dm_id))
 
     return True, dm_id
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_dms(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
     return True, db.get_user_dms(username)
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def get_dm(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    dm_id = int(data["id"])
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    username = logged_in[sid]
+    dm_id = utils.as_int(data["id"])
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
     dm = db.get_dm(dm_id)
-    dm["users_in_call"] = dm_calls_map[dm_id]
+    dm["users_in_call"] = call_snapshot(dm_id)
 
     # Gather the user's scheduled messages for this dm.
-    scheduled = scheduled_messages[dm_id][username]
-    s = {k: utils.exclude_keys(v, ["handle"]) for k,v in scheduled.items()}
+    s = {}
+    for sched_id in sorted(scheduled_by_dm_user.get((dm_id, username), ())):
+        entry = scheduled_messages[dm_id, username, sched_id]
+        s[sched_id] = {"message": entry.message, "signature": entry.signature, "timestamp": entry.timestamp}
     dm["scheduled_messages"] = s
 
     return True, dm
 
-@error_wrap
-@login_required_wrap
-@check_keys("id", "name")
 async def set_dm(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    dm_id = int(data["id"])
+    username = logged_in[sid]
+    dm_id = utils.as_int(data["id"])
     parsed = utils.get_keys(data, ["name"])
 
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
     db.set_dm_props(dm_id, parsed)
 
     # Notification
-    dm = utils.exclude_keys(db.get_dm(dm_id), ["latest_message"])
-    dm["users_in_call"] = dm_calls_map[dm_id]
-    utils.start_background_task(notifications.notify_dm(sio, dm))
+    dm = db.get_dm(dm_id)
+    del dm["latest_message"]
+    dm["users_in_call"] = call_snapshot(dm_id)
+    utils.start_background_task(notify(notifications.notify_dm(sio, dm)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def leave_dm(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    dm_id = int(data["id"])
+    dm_id = utils.as_int(data["id"])
 
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
+    # Read before leaving, get_dm can't load a dm with no users left.
+    dm = db.get_dm(dm_id)
     db.leave_dm(dm_id, username)
-    await notifications.user_leave_dm(sio, username, dm_id)
+    await notify(notifications.user_leave_dm(sio, username, dm_id))
 
     # Notification
-    dm = utils.exclude_keys(db.get_dm(dm_id), ["latest_message"])
-    dm["users_in_call"] = dm_calls_map[dm_id]
-    utils.start_background_task(notifications.notify_dm(sio, dm))
+    dm["users"].remove(username)
+    if not dm["users"]:
+        # Last user left, nobody to tell.
+        return True, True
+    del dm["latest_message"]
+    dm["users_in_call"] = call_snapshot(dm_id)
+    utils.start_background_task(notify(notifications.notify_dm(sio, dm)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("id", "message", "signature", "schedule", "delete")
 async def send_message(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    dm_id = int(data["id"])
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    dm_id = utils.as_int(data["id"])
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
-    dm = db.get_dm(dm_id)
-    if len(dm["users"]) == 2:
-        friends = db.get_of_status(dm["users"][0], "friend")
-        if dm["users"][1] not in friends:
-            return False, "You need to be friends to send messages here."
+    dm = utils.cached(db.get_dm, dm_id)
+    if len(dm["users"]) == 2 and not db.are_friends(*dm["users"]):
+        return False, "You need to be friends to send messages here."
 
     msg = data["message"]
     sig = data["signature"]
-    pub = db.get_user(username)["public_key"]
-    Ed25519.verify(pub, msg, sig)
+    pub = utils.cached(db.get_user, username)["public_key"]
+    await Ed25519.verify_async(bytes.fromhex(pub), bytes.fromhex(msg), bytes.fromhex(sig))
+
+    schedule = utils.as_int(data["schedule"])
+    delete = utils.as_int(data["delete"])
 
-    schedule = int(data["schedule"])
-    delete = int(data["delete"])
+    # Self destruct message handling
+    async def delete_handler(m_id):
+        db.delete_message(m_id)
+        utils.start_background_task(notify(notifications.notify_message_delete(sio, dm_id, m_id)))
 
     # Scheduled messages handling
-    async def schedule_handler(sched_id):
-        pre = max(schedule - 60, 0) # Clamp to zero.
-        post = schedule - pre
-        if pre > 0:
-            await asyncio.sleep(pre)
-            await notifications.notify_sched_soon(sio, username, dm_id, sched_id)
-        await asyncio.sleep(post)
+    if schedule > 0:
+        key = (dm_id, username)
+        sched_id = sched_id_counter[key] = sched_id_counter.get(key, 0) + 1
 
-        # No longer scheduled so clean up the scheduled entries.
-        del scheduled_messages[dm_id][username][sched_id]
+        async def soon_handler():
+            utils.start_background_task(notify(notifications.notify_sched_soon(sio, username, dm_id, sched_id)))
 
-        m = db.create_message(dm_id, username, msg, sig, delete)
+        async def schedule_handler():
+            # No longer scheduled so clean up the scheduled entries.
+            remove_scheduled(dm_id, username, sched_id)
 
-        # Tell the user their message got sent. Also do regular message notifications.
-        await notifications.notify_sched_message(sio, username, dm_id, sched_id)
-        await notifications.notify_message(sio, dm_id, m)
+            m = db.create_message(dm_id, username, msg, sig, delete)
 
-        if delete > 0:
-            # Wait for delete (if it was set to delete).
-            await asyncio.sleep(delete)
-            db.delete_message(m["id"])
-            await notifications.notify_message_delete(sio, dm_id, m["id"])
+            # Tell the user their message got sent. Also do regular message notifications.
+            utils.start_background_task(notify(notifications.notify_sched_message(sio, username, dm_id, sched_id)))
+            utils.start_background_task(notify(notifications.notify_message(sio, dm_id, m)))
 
-    if schedule > 0:
-        # This task also handles self destructs.
-        sched_id = max(scheduled_messages[dm_id][username], default=0) + 1
-        handle = utils.start_background_task(schedule_handler(sched_id))
+            if delete > 0:
+                # Delete later (if it was set to delete).
+                scheduler.schedule(delete, lambda: delete_handler(m["id"]))
+
+        pre = max(schedule - 60, 0) # Clamp to zero.
+        handles = [scheduler.schedule(schedule, schedule_handler)]
+        if pre > 0:
+            handles.append(scheduler.schedule(pre, soon_handler))
         timestamp = utils.now_delta(schedule)
-        scheduled_messages[dm_id][username][sched_id] = {
-            "message": msg, "signature": sig, "timestamp": timestamp, "handle": handle
-        }
+        add_scheduled(dm_id, username, sched_id, ScheduledMessage(msg, sig, timestamp, handles))
         return True, True
 
     # Notification
     m = db.create_message(dm_id, username, msg, sig, delete)
-    utils.start_background_task(notifications.notify_message(sio, dm_id, m))
-
-    # Self destruct message handling
-    async def delete_handler():
-        await asyncio.sleep(delete)
-        db.delete_message(m["id"])
-        await notifications.notify_message_delete(sio, dm_id, m["id"])
+    utils.start_background_task(notify(notifications.notify_message(sio, dm_id, m)))
 
     if delete > 0:
         # Only apply deleter when scheduler didn't start and we need to delete.
-        utils.start_background_task(delete_handler())
+        scheduler.schedule(delete, lambda: delete_handler(m["id"]))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def get_message(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    m_id = int(data["id"])
+    m_id = utils.as_int(data["id"])
 
-    if not db.message_exists(m_id) or not db.message_in_user_dm(m_id, username):
+    if not db.message_in_user_dm(m_id, username):
         # Message doesn't exist or user can't see it.
         return False, "You do not have access to that Message."
 
     return True, db.get_message(m_id)
 
-@error_wrap
-@login_required_wrap
-@check_keys("id", "cursor", "limit")
 async def get_message_history(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    dm_id = int(data["id"])
+    dm_id = utils.as_int(data["id"])
     # Just check it is a timestamp.
-    _ = datetime.strptime(data["cursor"], "%Y-%m-%dT%H:%M:%S.%f%z")
-    limit = int(data["limit"])
+    _ = datetime.fromisoformat(data["cursor"])
+    limit = utils.as_int(data["limit"])
 
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
     return True, db.get_messages(dm_id, data["cursor"], limit)
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def get_pinned(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
     
-    dm_id = int(data["id"])
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    dm_id = utils.as_int(data["id"])
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
     return True, db.get_pinned_messages(dm_id)
 
-@error_wrap
-@login_required_wrap
 async def set_message(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    m_id = int(data["id"])
+    username = logged_in[sid]
+    m_id = utils.as_int(data["id"])
     parsed = utils.get_keys(data, ["message", "signature", "pinned"])
 
-    if not db.message_exists(m_id) or not db.message_in_user_dm(m_id, username):
+    if not db.message_in_user_dm(m_id, username):
         # Message doesn't exist or not a part of the user's dms.
         return False, "You do not have access to that message."
 
@@ -499,69 +501,56 @@ async def set_message(sio: socketio.AsyncServer, sid, data):
             return False, "You cannot edit that message."
         msg = parsed["message"]
         sig = parsed["signature"]
-        pub = db.get_user(username)["public_key"]
-        Ed25519.verify(pub, msg, sig)
+        pub = utils.cached(db.get_user, username)["public_key"]
+        await Ed25519.verify_async(bytes.fromhex(pub), bytes.fromhex(msg), bytes.fromhex(sig))
 
     db.set_message_props(m_id, parsed)
 
     # Notification
     m = db.get_message(m_id)
     dm_id = m["dm_id"]
-    utils.start_background_task(notifications.notify_message_change(sio, dm_id, m))
+    utils.start_background_task(notify(notifications.notify_message_change(sio, dm_id, m)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("dm_id", "schedule_id")
 async def cancel_scheduled_message(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    dm_id = int(data["dm_id"])
-    schedule_id = int(data["schedule_id"])
+    username = logged_in[sid]
+    dm_id = utils.as_int(data["dm_id"])
+    schedule_id = utils.as_int(data["schedule_id"])
 
-    scheduled = scheduled_messages[dm_id][username]
-    if schedule_id not in scheduled:
+    if (dm_id, username, schedule_id) not in scheduled_messages:
         return False, "You did not schedule a message with that id."
 
-    # This should cleanly cancel the task.
-    scheduled[schedule_id]["handle"].cancel()
-    del scheduled[schedule_id]
+    # Drop the pending send (and soon notification) from the scheduler.
+    for handle in remove_scheduled(dm_id, username, schedule_id).handles:
+        scheduler.cancel(handle)
 
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("id", "reaction", "signature")
 async def add_reaction(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    m_id = int(data["id"])
-    if not db.message_exists(m_id) or not db.message_in_user_dm(m_id, username):
+    m_id = utils.as_int(data["id"])
+    if not db.message_in_user_dm(m_id, username):
         # Message doesn't exist or not a part of the user's dms.
         return False, "You do not have access to that message."
 
     reaction = data["reaction"]
     sig = data["signature"]
-    pub = db.get_user(username)["public_key"]
-    Ed25519.verify(pub, reaction, sig)
+    pub = utils.cached(db.get_user, username)["public_key"]
+    await Ed25519.verify_async(bytes.fromhex(pub), bytes.fromhex(reaction), bytes.fromhex(sig))
 
     reaction_id = db.create_reaction(m_id, username, reaction, sig)
 
     # Notification
     m = db.get_message(m_id)
     dm_id = m["dm_id"]
-    utils.start_background_task(notifications.notify_message_change(sio, dm_id, m))
+    utils.start_background_task(notify(notifications.notify_message_change(sio, dm_id, m)))
     return True, reaction_id
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def remove_reaction(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    reaction_id = int(data["id"])
+    reaction_id = utils.as_int(data["id"])
     if not db.reaction_exists(reaction_id) or db.get_reaction(reaction_id)["sender"] != username:
         # Reaction doesn't exist or wasn't by this user.
         return False, "You do not have access to that reaction."
@@ -571,267 +560,230 @@ async def remove_reaction(sio: socketio.AsyncServer, sid, data):
     # Notification
     m = db.get_message(m_id)
     dm_id = m["dm_id"]
-    utils.start_background_task(notifications.notify_message_change(sio, dm_id, m))
+    utils.start_background_task(notify(notifications.notify_message_change(sio, dm_id, m)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def ping_typing(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
-    dm_id = data["id"]
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    dm_id = utils.as_int(data["id"])
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
-    users = db.get_dm(dm_id)["users"]
+    users = utils.cached(db.get_dm, dm_id)["users"]
 
-    if len(users) == 2 and users[1] not in db.get_of_status(users[0], "friend"):
+    if len(users) == 2 and not db.are_friends(*users):
         # Individual DM users need to be friends.
         return False, "You need to be friends to send messages here."
 
     # Notification
-    utils.start_background_task(notifications.notify_typing(sio, sid, username, dm_id))
+    utils.start_background_task(notify(notifications.notify_typing(sio, sid, username, dm_id)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("username")
 async def send_friend_request(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        sender = session["username"]
+    sender = logged_in[sid]
     username = data["username"]
 
     # False if friending self, blocked by target, already friends or already requested.
     if sender == username:
         return False, "You cannot friend yourself."
 
-    if not db.user_exists(username) or db.is_relation(username, sender, "block"):
+    rel = db.get_relations_between(sender, username)
+    if not rel["b_exists"] or rel["b_to_a"] == "block":
         return False, "Could not friend that person."
 
-    if username in db.get_of_status(sender, "friend"):
+    if "friend" in (rel["a_to_b"], rel["b_to_a"]):
         return False, "You are already friends."
 
-    if db.is_relation(sender, username, "request"):
+    if rel["a_to_b"] == "request":
         return False, "You have already sent a request."
 
-    if db.is_relation(username, sender, "request"):
+    if rel["b_to_a"] == "request":
         return False, "That user has already sent a request to you."
 
     # Unblock if applicable.
-    if db.is_relation(sender, username, "block"):
+    if rel["a_to_b"] == "block":
         db.delete_relation(sender, username)
     db.create_relation(sender, username, "request")
 
     # Notification
-    utils.start_background_task(notifications.notify_friend_request(sio, sender, username))
+    utils.start_background_task(notify(notifications.notify_friend_request(sio, sender, username)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_friend_requests(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
     return True, db.get_incoming_of_status(username, "request")
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_outgoing_requests(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
 
     return True, db.get_outgoing_of_status(username, "request")
 
-@error_wrap
-@login_required_wrap
-@check_keys("username", "accept")
 async def ack_friend_request(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
     sender = data["username"]
     accept = bool(data["accept"])
 
     # False if no request or already friends.
-    if not db.user_exists(sender) or not db.is_relation(sender, username, "request"):
+    rel = db.get_relations_between(sender, username)
+    if not rel["a_exists"] or rel["a_to_b"] != "request":
         return False, "That user did not send you a request."
 
-    if username in db.get_of_status(sender, "friend"):
+    if rel["b_to_a"] == "friend":
         return False, "You are already friends."
 
     if accept:
         db.set_relation_props(sender, username, {"status_code": "friend"})
         # Unblock if applicable.
-        if db.is_relation(username, sender, "block"):
+        if rel["b_to_a"] == "block":
             db.delete_relation(username, sender)
     else:
         db.delete_relation(sender, username)
 
     # Notification
-    utils.start_background_task(notifications.notify_friend_accept_request(sio, sender, username, accept))
+    utils.start_background_task(notify(notifications.notify_friend_accept_request(sio, sender, username, accept)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("username")
 async def unfriend(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
     other = data["username"]
-    if not db.user_exists(other) or other not in db.get_of_status(username, "friend"):
+    # Only existing users can be in the friends set.
+    if not db.are_friends(username, other):
         return False, "You are not friends with that user."
 
-    utils.unfriend(username, other)
-    utils.start_background_task(notifications.notify_friend_unfriend(sio, username, other))
+    await db.run_async(utils.unfriend, username, other)
+    utils.start_background_task(notify(notifications.notify_friend_unfriend(sio, username, other)))
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_friends(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    return True, db.get_of_status(username, "friend")
+    username = logged_in[sid]
+    return True, list(db.get_friends(username))
 
-@error_wrap
-@login_required_wrap
-@check_keys("username")
 async def block_user(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        sender = session["username"]
+    sender = logged_in[sid]
     username = data["username"]
 
     # False if no such user or already blocked.
-    if not db.user_exists(sender) or db.is_relation(sender, username, "block"):
+    rel = db.get_relations_between(sender, username)
+    if not rel["b_exists"] or rel["a_to_b"] == "block":
         return False, "You cannot block that user."
 
     # Automatically unfriend if they were friends.
-    if username in db.get_of_status(sender, "friend"):
-        utils.unfriend(sender, username)
+    if "friend" in (rel["a_to_b"], rel["b_to_a"]):
+        await db.run_async(utils.unfriend, sender, username)
 
     # Automatically retract friendship request if present.
-    if db.is_relation(sender, username, "request"):
+    if rel["a_to_b"] == "request":
         db.delete_relation(sender, username)
 
     db.create_relation(sender, username, "block")
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys("username")
 async def unblock_user(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        sender = session["username"]
+    sender = logged_in[sid]
     username = data["username"]
 
     # False if no such user or not blocked.
-    if not db.user_exists(sender) or not db.is_relation(sender, username, "block"):
+    if not db.is_relation(sender, username, "block"):
         return False, "You cannot unblock that user."
 
     db.delete_relation(sender, username)
     return True, True
 
-@error_wrap
-@login_required_wrap
-@check_keys()
 async def get_blocked(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
+    username = logged_in[sid]
     return True, db.get_outgoing_of_status(username, "block")
 
-@error_wrap
-@login_required_wrap
-@check_keys("id", "uuid")
 async def join_call(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    dm_id = int(data["id"])
+    username = logged_in[sid]
+    dm_id = utils.as_int(data["id"])
     uuid = str(data["uuid"])
 
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
-    dm_calls_map[dm_id][username] = uuid
+    add_to_call(dm_id, username, uuid)
 
     # Notification
     dm = db.get_dm(dm_id)
-    dm["users_in_call"] = dm_calls_map[dm_id]
-    utils.start_background_task(notifications.notify_dm(sio, dm))
-    return True, dm_calls_map[dm_id]
+    dm["users_in_call"] = call_snapshot(dm_id)
+    utils.start_background_task(notify(notifications.notify_dm(sio, dm)))
+    return True, dm["users_in_call"]
 
-@error_wrap
-@login_required_wrap
-@check_keys("id")
 async def leave_call(sio: socketio.AsyncServer, sid, data):
-    async with sio.session(sid) as session:
-        username = session["username"]
-    dm_id = int(data["id"])
+    username = logged_in[sid]
+    dm_id = utils.as_int(data["id"])
 
-    if not db.dm_exists(dm_id) or not db.user_in_dm(username, dm_id):
+    if utils.cached(db.dm_membership, dm_id, username) is None:
         # DM doesn't exist or user isn't a part of the dm.
         return False, "You do not have access to that DM."
 
     if username not in dm_calls_map[dm_id]:
         return False, "You are not part of the call."
 
-    del dm_calls_map[dm_id][username]
+    remove_from_call(dm_id, username)
 
     # Notification
     dm = db.get_dm(dm_id)
-    dm["users_in_call"] = dm_calls_map[dm_id]
-    utils.start_background_task(notifications.notify_dm(sio, dm))
+    dm["users_in_call"] = call_snapshot(dm_id)
+    utils.start_background_task(notify(notifications.notify_dm(sio, dm)))
     return True, True
 
-def check_for_keys(data, *keys):
+def check_for_keys(data, keys: frozenset):
     """Tests for exact key existence in a dict."""
     if not isinstance(data, dict):
         return False
-    return set(data) == set(keys)
+    return len(data) == len(keys) and keys.issubset(data)
+
+# (event, handler, required keys or None, needs login, is a login attempt)
+HANDLERS = [
+    ("login", login, ("username",), False, True),
+    ("login_challenge_response", login_challenge_response, ("response",), False, True),
+    ("register", register, ("username", "public_key", "spk", "sig", "own_storage"), False, False),
+
+    ("username_exists", username_exists, ("username",), False, False),
+    ("get_user", get_user, ("username",), True, False),
+    ("get_full_user", get_full_user, (), True, False),
+    ("get_user_list", get_user_list, (), True, False),
+    ("set_user", set_user, None, True, False),
+
+    ("create_dm", create_dm, ("usernames", "messages", "key_tree"), True, False),
+    ("get_dms", get_dms, (), True, False),
+    ("get_dm", get_dm, ("id",), True, False),
+    ("set_dm", set_dm, ("id", "name"), True, False),
+    ("leave_dm", leave_dm, ("id",), True, False),
+
+    ("send_message", send_message, ("id", "message", "signature", "schedule", "delete"), True, False),
+    ("get_message", get_message, ("id",), True, False),
+    ("get_message_history", get_message_history, ("id", "cursor", "limit"), True, False),
+    ("get_pinned", get_pinned, ("id",), True, False),
+    ("set_message", set_message, None, True, False),
+    ("cancel_scheduled_message", cancel_scheduled_message, ("dm_id", "schedule_id"), True, False),
+
+    ("add_reaction", add_reaction, ("id", "reaction", "signature"), True, False),
+    ("remove_reaction", remove_reaction, ("id",), True, False),
+
+    ("ping_typing", ping_typing, ("id",), True, False),
+
+    ("send_friend_request", send_friend_request, ("username",), True, False),
+    ("get_friend_requests", get_friend_requests, (), True, False),
+    ("get_outgoing_requests", get_outgoing_requests, (), True, False),
+    ("ack_friend_request", ack_friend_request, ("username", "accept"), True, False),
+    ("unfriend", unfriend, ("username",), True, False),
+    ("get_friends", get_friends, (), True, False),
+
+    ("block_user", block_user, ("username",), True, False),
+    ("unblock_user", unblock_user, ("username",), True, False),
+    ("get_blocked", get_blocked, (), True, False),
+
+    ("join_call", join_call, ("id", "uuid"), True, False),
+    ("leave_call", leave_call, ("id",), True, False),
+]
 
 def register_events(sio: socketio.AsyncServer):
-    sio.on("login", functools.partial(login, sio))
-    sio.on("login_challenge_response", functools.partial(login_challenge_response, sio))
-    sio.on("register", functools.partial(register, sio))
-
-    sio.on("username_exists", functools.partial(username_exists, sio))
-    sio.on("get_user", functools.partial(get_user, sio))
-    sio.on("get_full_user", functools.partial(get_full_user, sio))
-    sio.on("get_user_list", functools.partial(get_user_list, sio))
-    sio.on("set_user", functools.partial(set_user, sio))
-
-    sio.on("create_dm", functools.partial(create_dm, sio))
-    sio.on("get_dms", functools.partial(get_dms, sio))
-    sio.on("get_dm", functools.partial(get_dm, sio))
-    sio.on("set_dm", functools.partial(set_dm, sio))
-    sio.on("leave_dm", functools.partial(leave_dm, sio))
-
-    sio.on("send_message", functools.partial(send_message, sio))
-    sio.on("get_message", functools.partial(get_message, sio))
-    sio.on("get_message_history", functools.partial(get_message_history, sio))
-    sio.on("get_pinned", functools.partial(get_pinned, sio))
-    sio.on("set_message", functools.partial(set_message, sio))
-    sio.on("cancel_scheduled_message", functools.partial(cancel_scheduled_message, sio))
-
-    sio.on("add_reaction", functools.partial(add_reaction, sio))
-    sio.on("remove_reaction", functools.partial(remove_reaction, sio))
-
-    sio.on("ping_typing", functools.partial(ping_typing, sio))
-
-    sio.on("send_friend_request", functools.partial(send_friend_request, sio))
-    sio.on("get_friend_requests", functools.partial(get_friend_requests, sio))
-    sio.on("get_outgoing_requests", functools.partial(get_outgoing_requests, sio))
-    sio.on("ack_friend_request", functools.partial(ack_friend_request, sio))
-    sio.on("unfriend", functools.partial(unfriend, sio))
-    sio.on("get_friends", functools.partial(get_friends, sio))
-
-    sio.on("block_user", functools.partial(block_user, sio))
-    sio.on("unblock_user", functools.partial(unblock_user, sio))
-    sio.on("get_blocked", functools.partial(get_blocked, sio))
-
-    sio.on("join_call", functools.partial(join_call, sio))
-    sio.on("leave_call", functools.partial(leave_call, sio))
+    for event, f, keys, needs_login, is_login in HANDLERS:
+        # Register the bound coroutine method so socketio awaits it.
+        sio.on(event, Handler(sio, f, keys, needs_login, is_login).handle)
@@ -1,7 +1,13 @@
+import logging
 import socketio
 import uvicorn
 from app import sio
 
+# Event logging. Per event debug lines are skipped unless this is lowered.
+logger = logging.getLogger("events")
+logger.addHandler(logging.StreamHandler())
+logger.setLevel(logging.INFO)
+
 app = socketio.ASGIApp(sio)
 
 if __name__ == "__main__":
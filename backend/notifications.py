@@ -1,122 +1,253 @@
+import asyncio
+from collections import deque
+import contextvars
+import logging
 import utils
 import database as db
+import scheduler
 from socketio import AsyncServer
-from collections import defaultdict
+
+logger = logging.getLogger("events.notifications")
 
 user_room = "ROOM_USER_{}"
 dm_room = "ROOM_DM_{}_NOTIFICATION"
-name_map = defaultdict(set)
-
-async def login_join_rooms(sio: AsyncServer, sid):
+# username -> sids of their logged in connections. Only online users have entries.
+name_map: "dict[str, list]" = {}
+# (dm_id, username) -> timer for a typing notification waiting to go out.
+typing_pending: "dict[tuple[int, str], asyncio.TimerHandle]" = {}
+TYPING_DELAY = 0.2
+# Limit on emits in flight from background work like scheduled messages.
+EMIT_LIMIT = 32
+emit_limit = asyncio.Semaphore(EMIT_LIMIT)
+# Formatted room names so notifications don't format them on every emit.
+user_rooms = {}
+dm_rooms = {}
+
+def user_room_name(username: str) -> str:
+    """Name of the room every sid of the user is in."""
+    room = user_rooms.get(username)
+    if room is None:
+        room = user_rooms[username] = user_room.format(username)
+    return room
+
+def dm_room_name(dm_id: int) -> str:
+    """Name of the room for a dm's notifications."""
+    room = dm_rooms.get(dm_id)
+    if room is None:
+        room = dm_rooms[dm_id] = dm_room.format(dm_id)
+    return room
+
+async def bounded_emit(sio: AsyncServer, *args, **kwargs):
+    """sio.emit, waiting if EMIT_LIMIT of these are already in flight.
+    Used for notifications fired from background work, which can come in bursts."""
+    async with emit_limit:
+        await sio.emit(*args, **kwargs)
+
+def enter_rooms(sio: AsyncServer, sid, rooms: "list[str]", namespace: str = "/"):
+    """Join a sid to several rooms in one go, going to the manager directly
+    instead of through the server for each room."""
+    manager = sio.manager
+    for room in rooms:
+        manager.enter_room(sid, namespace, room)
+
+async def broadcast(sio: AsyncServer, event: str, data, room=None, skip_sid=None,
+                    namespace: str = "/"):
+    """Emit to a room (everyone if room is None). Goes through sio.emit so the
+    client manager in use decides how the packet reaches each recipient."""
+    await sio.emit(event, data, to=room, skip_sid=skip_sid, namespace=namespace)
+
+class EmitBatcher:
+    """Queues broadcasts per room. Each room with queued broadcasts has one
+    drain task sending them in the order they were queued, so everything
+    queued while it runs goes out from that same task. The returned future
+    finishes once that broadcast has been sent."""
+    __slots__ = ("queues",)
+
+    def __init__(self):
+        self.queues: "dict[str, deque[tuple[AsyncServer, str, object, object, asyncio.Future]]]" = {}
+
+    def enqueue(self, sio: AsyncServer, event: str, data, room: str, skip_sid=None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(room)
+        if queue is None:
+            queue = self.queues[room] = deque()
+            # Fresh context, the drain is not part of the request that queued it.
+            utils.start_background_task(self.drain(room, queue), context=contextvars.Context())
+        queue.append((sio, event, data, skip_sid, future))
+        return future
+
+    async def drain(self, room: str, queue: deque):
+        """Send the room's queued broadcasts until none are left."""
+        try:
+            while queue:
+                sio, event, data, skip_sid, future = queue.popleft()
+                try:
+                    await broadcast(sio, event, data, room, skip_sid)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                    continue
+                if not future.done():
+                    future.set_result(None)
+        finally:
+            if self.queues.get(room) is queue:
+                del self.queues[room]
+
+emit_batcher = EmitBatcher()
+
+async def login_join_rooms(sio: AsyncServer, sid, username: str):
     """Make this user join all the rooms for dm notifications at login time."""
-    async with sio.session(sid) as session:
-        username = session["username"]
-        name_map[username].add(sid)
-    dms = db.get_user_dms(username)
-    for dm_id in dms:
-        sio.enter_room(sid, dm_room.format(dm_id))
-    sio.enter_room(sid, user_room.format(username))
+    # Users only have a few tabs open, a short list beats a set here.
+    sids = name_map.setdefault(username, [])
+    if sid not in sids:
+        sids.append(sid)
+    dms, notifs = await asyncio.gather(
+        db.run_async(db.get_user_dms, username),
+        db.run_async(db.get_and_clear_x3dh, username))
+    if sid not in name_map.get(username, ()):
+        # Disconnected while the queries ran, keep the x3dh payloads for next time.
+        if notifs:
+            await db.run_async(db.requeue_x3dh, username, notifs)
+        return
+    rooms = [dm_room_name(dm_id) for dm_id in dms]
+    rooms.append(user_room_name(username))
+    enter_rooms(sio, sid, rooms)
 
     # Send any pending x3dh notifications 5 seconds after connect time.
-    for notif in db.get_and_clear_x3dh(username):
-        task = utils.delay_task(5.0, notify_x3dh(sio, username, notif))
-        utils.start_background_task(task)
+    for notif in notifs:
+        scheduler.schedule(5.0, lambda notif=notif: notify_x3dh(sio, username, notif))
 
 async def join_new_dm(sio: AsyncServer, dm_id: int):
     """Update users to be joined for a new dm. Should only be called
     after a new dm is made."""
-    dm = db.get_dm(dm_id)
+    dm = await db.run_async(db.get_dm, dm_id)
+    # Name the room once here so later notifications find it cached.
+    room = dm_room_name(dm_id)
+    manager = sio.manager
     for username in dm["users"]:
-        for sid in name_map[username]:
-            sio.enter_room(sid, dm_room.format(dm_id))
-
-async def remove_sid(sio: AsyncServer, sid):
-    """Remove an sid for notifications. Should only be called on disconnect."""
-    async with sio.session(sid) as session:
-        if not session["logged_in"]:
-            return
-        username = session["username"]
-        name_map[username].remove(sid)
-
-    for room in sio.rooms(sid):
-        sio.leave_room(sid, room)
-    sio.leave_room(sid, user_room.format(username))
+        for sid in name_map.get(username, ()):
+            manager.enter_room(sid, "/", room)
+
+async def remove_sid(sio: AsyncServer, sid, username: str):
+    """Remove a logged in sid for notifications. Should only be called on disconnect.
+    socketio takes the sid out of all its rooms once the disconnect handler returns."""
+    sids = name_map[username]
+    sids.remove(sid)
+    if not sids:
+        # Last connection for this user is gone.
+        del name_map[username]
+        user_rooms.pop(username, None)
 
 async def user_leave_dm(sio: AsyncServer, username: str, dm_id: int):
     """Remove user from the specified dm notifications."""
-    for sid in name_map[username]:
-        sio.leave_room(sid, dm_room.format(dm_id))
+    room = dm_room_name(dm_id)
+    for sid in name_map.get(username, ()):
+        sio.leave_room(sid, room)
+    if not sio.manager.rooms.get("/", {}).get(room):
+        # Nobody online is left in the dm, stop caching its room name.
+        dm_rooms.pop(dm_id, None)
 
 async def notify_profile(sio: AsyncServer, sid, user: dict):
     """Notify everyone except the user about a profile update."""
-    await sio.emit("profile_notification", user, skip_sid=sid)
+    await broadcast(sio, "profile_notification", user, skip_sid=sid)
 
 async def notify_dm(sio: AsyncServer, dm: dict):
     """Notify all users in a dm that it has changed."""
     dm_id = dm["id"]
-    await sio.emit("dm_notification", dm, to=dm_room.format(dm_id))
+    await emit_batcher.enqueue(sio, "dm_notification", dm, dm_room_name(dm_id))
 
-async def notify_typing(sio: AsyncServer, sid, username: str, dm_id: int):
-    """Notify users in a dm of a typing ping event."""
+def flush_typing(sio: AsyncServer, sid, username: str, dm_id: int):
+    """Send the typing notification held back by notify_typing."""
+    del typing_pending[(dm_id, username)]
     payload = {
         "id": dm_id,
         "username": username
     }
-    await sio.emit("typing_notification", payload, to=dm_room.format(dm_id), skip_sid=sid)
+    sent = emit_batcher.enqueue(sio, "typing_notification", payload, dm_room_name(dm_id), sid)
+    sent.add_done_callback(log_failure)
+
+def log_failure(future: asyncio.Future):
+    """Done callback for broadcasts nobody awaits, so errors still get reported."""
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("Notification failed.", exc_info=future.exception())
+
+async def notify_typing(sio: AsyncServer, sid, username: str, dm_id: int):
+    """Notify users in a dm of a typing ping event.
+    Pings are held for TYPING_DELAY seconds and repeats in that window are dropped."""
+    key = (dm_id, username)
+    if key in typing_pending:
+        return
+    loop = asyncio.get_running_loop()
+    typing_pending[key] = loop.call_later(TYPING_DELAY, flush_typing, sio, sid, username, dm_id,
+                                          context=contextvars.Context())
 
 async def notify_message(sio: AsyncServer, dm_id: int, message: dict):
     """Notify all users a part of this dm with the latest message."""
-    await sio.emit("message_notification", message, to=dm_room.format(dm_id))
+    await emit_batcher.enqueue(sio, "message_notification", message, dm_room_name(dm_id))
 
 async def notify_message_change(sio: AsyncServer, dm_id: int, message: dict):
     """Notify all users a part of this dm with the changed message."""
-    await sio.emit("message_change_notification", message, to=dm_room.format(dm_id))
+    await emit_batcher.enqueue(sio, "message_change_notification", message, dm_room_name(dm_id))
 
 async def notify_message_delete(sio: AsyncServer, dm_id: int, payload):
     """Notify all users a part of this dm with the deleted message."""
-    await sio.emit("message_delete_notification", payload, to=dm_room.format(dm_id))
+    await emit_batcher.enqueue(sio, "message_delete_notification", payload, dm_room_name(dm_id))
 
 async def notify_sched_message(sio: AsyncServer, username: str, dm_id, schedule_id):
     """Notify user their scheduled message got sent."""
+    if not is_user_online(username):
+        return
     payload = {
         "dm_id": dm_id,
         "schedule_id": schedule_id
     }
-    await sio.emit("scheduled_message_sent_notification", payload, to=user_room.format(username))
+    await bounded_emit(sio, "scheduled_message_sent_notification", payload, to=user_room_name(username))
 
 async def notify_sched_soon(sio: AsyncServer, username: str, dm_id, schedule_id):
     """Notify user their scheduled message will be sent shortly."""
+    if not is_user_online(username):
+        return
     payload = {
         "dm_id": dm_id,
         "schedule_id": schedule_id
     }
-    await sio.emit("scheduled_soon_notification", payload, to=user_room.format(username))
+    await bounded_emit(sio, "scheduled_soon_notification", payload, to=user_room_name(username))
 
 async def notify_x3dh(sio: AsyncServer, username: str, payload):
     """Send X3DH notification to the username.
     Should be called when a new request is made."""
-    await sio.emit("x3dh_notification", payload, to=user_room.format(username))
+    if not is_user_online(username):
+        return
+    await bounded_emit(sio, "x3dh_notification", payload, to=user_room_name(username))
 
 async def notify_friend_request(sio: AsyncServer, sender: str, username: str):
     """Notify user of a new friend request."""
+    if not is_user_online(username):
+        return
     payload = {
         "username": sender
     }
-    await sio.emit("friend_request_notification", payload, to=user_room.format(username))
+    await sio.emit("friend_request_notification", payload, to=user_room_name(username))
 
 async def notify_friend_accept_request(sio: AsyncServer, sender: str, username: str, accept: bool):
     """Notify user of acceptance of their friend request."""
+    if not is_user_online(sender):
+        return
     payload = {
         "username": username,
         "accept": accept
     }
-    await sio.emit("friend_request_accept_notification", payload, to=user_room.format(sender))
+    await sio.emit("friend_request_accept_notification", payload, to=user_room_name(sender))
 
 async def notify_friend_unfriend(sio: AsyncServer, u1: str, u2: str):
     """Notify user of an unfriend."""
-    payloads = [{"username": u1}, {"username": u2}]
-    await sio.emit("unfriend_notification", payloads[0], to=user_room.format(u2))
-    await sio.emit("unfriend_notification", payloads[1], to=user_room.format(u1))
+    emits = []
+    if is_user_online(u2):
+        emits.append(sio.emit("unfriend_notification", {"username": u1}, to=user_room_name(u2)))
+    if is_user_online(u1):
+        emits.append(sio.emit("unfriend_notification", {"username": u2}, to=user_room_name(u1)))
+    await asyncio.gather(*emits)
 
 def is_user_online(username: str):
-    return len(name_map[username]) > 0
+    """True if the user has a logged in connection, so their user room has members."""
+    return bool(name_map.get(username))
@@ -0,0 +1,79 @@
+"""
+Runs delayed work from a single timer loop instead of one sleeping task per
+timer. Entries are kept in a heap ordered by when they are due.
+"""
+
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+from typing import Awaitable, Callable
+import utils
+
+logger = logging.getLogger("events.scheduler")
+
+# (due time, entry id). Entries cancelled before they are due stay here
+# until they pop or the heap is compacted.
+heap: "list[tuple[float, int]]" = []
+# entry id -> factory making the coroutine to run, for entries still waiting.
+pending: "dict[int, Callable[[], Awaitable]]" = {}
+_ids = itertools.count(1)
+_wakeup = None
+_runner = None
+
+def schedule(delay: float, factory: Callable[[], Awaitable]) -> int:
+    """Await factory() after delay seconds. Returns an id usable with cancel."""
+    global _wakeup, _runner
+    loop = asyncio.get_running_loop()
+    entry_id = next(_ids)
+    pending[entry_id] = factory
+    heapq.heappush(heap, (loop.time() + delay, entry_id))
+    if _runner is None:
+        # Start the timer loop on first use. It gets a fresh context so jobs
+        # don't share the request cache of whichever request started it.
+        _wakeup = asyncio.Event()
+        _runner = asyncio.create_task(_run(), context=contextvars.Context())
+    _wakeup.set()
+    return entry_id
+
+def cancel(entry_id: int):
+    """Stop a scheduled entry from running. Does nothing if it already ran."""
+    if pending.pop(entry_id, None) is None:
+        return
+    if len(heap) > 64 and len(pending) < len(heap) // 2:
+        # Mostly cancelled entries left, drop them.
+        heap[:] = [entry for entry in heap if entry[1] in pending]
+        heapq.heapify(heap)
+
+async def _run():
+    """Sleep until the earliest entry is due or a new one is scheduled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        _wakeup.clear()
+        if not heap:
+            await _wakeup.wait()
+            continue
+
+        delay = heap[0][0] - loop.time()
+        if delay > 0:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        _, entry_id = heapq.heappop(heap)
+        factory = pending.pop(entry_id, None)
+        if factory is None:
+            # Cancelled.
+            continue
+        # Run entries side by side so a slow one doesn't hold up the rest.
+        utils.start_background_task(_call(factory))
+
+async def _call(factory: Callable[[], Awaitable]):
+    try:
+        await factory()
+    except Exception:
+        # Only this entry fails, the others still run.
+        logger.exception("Scheduled job failed.")
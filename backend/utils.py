@@ -1,41 +1,93 @@
 import asyncio
-from datetime import datetime, timedelta
-from typing import Coroutine
+import time
+from contextvars import ContextVar
+from typing import Callable, Coroutine
+
+# (seconds since epoch, "YYYY-MM-DDTHH:MM:SS") for the last second formatted.
+_ts_cache = (-1, "")
+
+def _format_us(t: int) -> str:
+    """ISO string for t microseconds since the epoch, in UTC. The seconds
+    part only goes through strftime when the second changes."""
+    global _ts_cache
+    secs, us = divmod(t, 1_000_000)
+    if secs != _ts_cache[0]:
+        _ts_cache = (secs, time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(secs)))
+    return f"{_ts_cache[1]}.{us:06d}"
 
 def now():
-    return datetime.utcnow().isoformat()
+    return _format_us(time.time_ns() // 1000)
 
 def now_delta(seconds: int):
-    delta = timedelta(seconds=seconds)
-    return (datetime.utcnow() + delta).isoformat()
+    return _format_us(time.time_ns() // 1000 + seconds * 1_000_000)
 
+# The event loop only keeps weak references to tasks, so fire and forget
+# tasks are held here until they finish. Callers that keep the task
+# themselves should use asyncio.create_task directly.
 background_tasks = set()
 
-async def delay_task(delay: float, coro: Coroutine):
-    """Sleep for delay seconds then await coro."""
-    await asyncio.sleep(delay)
-    await coro
-
-def start_background_task(coro: Coroutine):
+def start_background_task(coro: Coroutine, context=None):
     """Schedule execution of coro at the next opportunity.
     Returned object can be used to cancel the event."""
-    t = asyncio.create_task(coro)
+    t = asyncio.create_task(coro, context=context)
     background_tasks.add(t)
     t.add_done_callback(background_tasks.discard)
     return t
 
+# Per request memo of database reads. Set up by the event error wrapper.
+request_cache: ContextVar[dict] = ContextVar("request_cache")
+
+def cached(f: Callable, *args):
+    """Call f(*args) once per request and reuse the result after that.
+    Outside of a request this just calls f."""
+    cache = request_cache.get(None)
+    if cache is None:
+        return f(*args)
+    key = (f, args)
+    if key not in cache:
+        cache[key] = f(*args)
+    return cache[key]
+
+def clear_request_cache():
+    """Forget cached reads for the current request. Called on writes."""
+    cache = request_cache.get(None)
+    if cache is not None:
+        cache.clear()
+
+def as_int(x) -> int:
+    """int(x), skipping the conversion when the client already sent an int."""
+    return x if type(x) is int else int(x)
+
+_missing = object()
+
 def get_keys(d: dict, keys: list):
     """Get a dict with only the specified keys (if they exist)."""
-    return {k: d[k] for k in keys if k in d}
+    out = {}
+    for k in keys:
+        v = d.get(k, _missing)
+        if v is not _missing:
+            out[k] = v
+    return out
 
-def exclude_keys(d: dict, keys: list):
+def exclude_keys(d: dict, keys: "set | list"):
     """Get a dict without the specified keys."""
+    if not isinstance(keys, (set, frozenset)):
+        keys = set(keys)
     return {k:v for k,v in d.items() if k not in keys}
 
+# database imports utils, so it is bound on first use instead of at import time.
+_db = None
+
+def _get_db():
+    global _db
+    if _db is None:
+        import database
+        _db = database
+    return _db
+
 def unfriend(u1, u2):
     """Unfriend both users. Assumes already friends."""
-    # Cursed db import because it would make a circular dependency otherwise.
-    import database as db
+    db = _get_db()
     if db.is_relation(u1, u2, "friend"):
         # Relation is from 1 to 2.
         db.delete_relation(u1, u2)